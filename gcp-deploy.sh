@@ -246,7 +246,7 @@ deploy_to_cloud_run() {
         --platform=managed \
         --allow-unauthenticated \
         --service-account=$SA_EMAIL \
-        --set-env-vars="GOOGLE_APPLICATION_CREDENTIALS=$KEY_FILE_PATH" \
+        --set-env-vars="GOOGLE_APPLICATION_CREDENTIALS=$KEY_FILE_PATH,WORKERS=1" \
         --set-secrets="OPENAI_API_KEY=$SECRET_NAME:latest,$KEY_FILE_PATH=$SA_KEY_SECRET_NAME:latest" \
         --cpu=1 \
         --memory=512Mi \
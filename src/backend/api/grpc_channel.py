@@ -0,0 +1,12 @@
+# Channel options shared by the Google Cloud gRPC clients (STT and TTS)
+GRPC_CHANNEL_OPTIONS = [
+    # Unlimited message sizes, as the generated transports configure by default
+    ("grpc.max_send_message_length", -1),
+    ("grpc.max_receive_message_length", -1),
+    # Ping idle connections so they stay usable between turns
+    ("grpc.keepalive_time_ms", 30000),
+    # Only drop a connection after 10 minutes without any call
+    ("grpc.max_connection_idle_ms", 600000),
+    # Let gRPC retry transient failures transparently
+    ("grpc.enable_retries", 1),
+]
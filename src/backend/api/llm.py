@@ -1,19 +1,67 @@
 import logging
 import os
-# from openai import AsyncOpenAI # LangChain uses its own client wrapper
 import time
+from operator import itemgetter
+from typing import AsyncIterator, Dict, Optional, Sequence
+import httpx
+from openai import AsyncOpenAI
 from langchain_openai import ChatOpenAI
-from langchain.memory import ConversationBufferMemory
-from langchain.chains import LLMChain
+from langchain_core.chat_history import InMemoryChatMessageHistory
+from langchain_core.messages import BaseMessage, trim_messages
+from langchain_core.messages.utils import count_tokens_approximately
+from langchain_core.runnables import ConfigurableField, RunnablePassthrough
+from langchain_core.runnables.history import RunnableWithMessageHistory
 from langchain.prompts import (
     ChatPromptTemplate,
     MessagesPlaceholder,
     SystemMessagePromptTemplate,
     HumanMessagePromptTemplate,
 )
+from .semantic_cache import NO_CACHE_MARKER
 
 logger = logging.getLogger(__name__)
 
+# Utterances shorter than this many words are answered by the fast model
+FAST_MODEL_MAX_WORDS = 20
+
+# Messages kept per session; older turns are dropped since the prompt can't use them anyway
+HISTORY_MAX_MESSAGES = 40
+
+# Spoken when the LLM call fails
+FALLBACK_RESPONSE = "סליחה, אני לא יכול לענות כרגע. נא לנסות שוב מאוחר יותר."
+
+class BoundedChatMessageHistory(InMemoryChatMessageHistory):
+    """In-memory chat history that keeps only the most recent messages."""
+
+    max_messages: int = HISTORY_MAX_MESSAGES
+
+    def add_message(self, message: BaseMessage) -> None:
+        self.add_messages([message])
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        self.messages.extend(messages)
+        del self.messages[:-self.max_messages]
+
+
+class ResponseStream:
+    """
+    A streamed LLM response. Iterate it for the text fragments; afterwards `failed`
+    tells whether the LLM call errored, in which case the text is the fallback answer
+    or a truncated one and must not be reused.
+    """
+
+    def __init__(self):
+        self.failed = False
+        self.fragments: Optional[AsyncIterator[str]] = None
+
+    def __aiter__(self) -> AsyncIterator[str]:
+        return self.fragments
+
+    async def aclose(self):
+        """Stop the stream early, closing the underlying OpenAI response."""
+        await self.fragments.aclose()
+
+
 class LLMService:
     """
     Service for generating responses using OpenAI's language models via LangChain,
@@ -28,12 +76,32 @@ class LLMService:
             logger.warning("OPENAI_API_KEY not found in environment variables, LangChain might still find it.")
         
         self.model_name = "gpt-4o" # Or get from env var
+        self.fast_model_name = "gpt-4o-mini" # Used for short conversational turns
         
-        # Initialize the LangChain ChatOpenAI model
-        # Note: LangChain handles async differently; the chain invocation might be async.
-        self.llm = ChatOpenAI(model_name=self.model_name, temperature=0.7, max_tokens=150) 
+        # One persistent HTTP/2 connection pool shared by every OpenAI call (completions and
+        # embeddings), so requests reuse warm TLS sessions and multiplex over few connections
+        self.http_client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+            timeout=httpx.Timeout(30.0, connect=5.0),
+        )
+        self.client = AsyncOpenAI(api_key=api_key, http_client=self.http_client)
+        
+        # Initialize the LangChain ChatOpenAI models
+        # streaming=True makes the underlying OpenAI call use stream=True so tokens arrive incrementally
+        self.strong_model = ChatOpenAI(model_name=self.model_name, temperature=0.7, max_tokens=150, streaming=True,
+                                       http_async_client=self.http_client)
+        self.fast_model = ChatOpenAI(model_name=self.fast_model_name, temperature=0.7, max_tokens=150, streaming=True,
+                                     http_async_client=self.http_client)
         
-        logger.info(f"Initialized LLM service with model: {self.model_name}")
+        # One runnable for both; the model is picked per call via the "llm" config field
+        self.llm = self.strong_model.configurable_alternatives(
+            ConfigurableField(id="llm"),
+            default_key="strong",
+            fast=self.fast_model,
+        )
+        
+        logger.info("Initialized LLM service with models: %s (fast: %s)", self.model_name, self.fast_model_name)
         
         # System prompt remains the same
         self.system_prompt_text = """
@@ -42,7 +110,8 @@ class LLMService:
         Keep your responses conversational and concise.
         Be polite, helpful, and tailored to Israeli culture when appropriate.
         If you don't know something, say so in Hebrew rather than making up information.
-        """
+        If your answer depends on earlier messages in this conversation, start it with {no_cache_marker}
+        """.format(no_cache_marker=NO_CACHE_MARKER)
 
         # Create the prompt template including memory placeholder
         self.prompt = ChatPromptTemplate(
@@ -53,41 +122,110 @@ class LLMService:
             ]
         )
 
-    # Note: Memory is now managed per connection in main.py
-    # This service method now requires the memory object.
-    async def generate_response(self, text: str, memory: ConversationBufferMemory) -> str:
+        # Only the most recent turns that fit this token budget are sent with each request,
+        # so prompt size (and latency) stays flat however long the conversation gets.
+        # Tokens are estimated from characters: exact tiktoken counting would run (and on
+        # first use download its encoding) synchronously on the event loop.
+        self.history_max_tokens = 1500
+        self.trimmer = trim_messages(
+            max_tokens=self.history_max_tokens,
+            strategy="last",
+            token_counter=count_tokens_approximately,
+            start_on="human",
+        )
+
+        # Build the chain once; per-session history is injected and saved by the wrapper
+        self.chain = (
+            RunnablePassthrough.assign(chat_history=itemgetter("chat_history") | self.trimmer)
+            | self.prompt
+            | self.llm
+        )
+        self._histories: Dict[str, BoundedChatMessageHistory] = {}
+        self.chain_with_history = RunnableWithMessageHistory(
+            self.chain,
+            self.get_session_history,
+            input_messages_key="input",
+            history_messages_key="chat_history",
+        )
+
+    async def warmup(self):
+        """
+        Prime the connection pool with a minimal completion.
+        
+        Called when a client connects, so the TCP/TLS handshake happens while the user
+        is still speaking rather than in front of the first real request.
+        """
+        try:
+            await self.client.chat.completions.create(
+                model=self.fast_model_name,
+                max_tokens=1,
+                messages=[{"role": "user", "content": "."}],
+            )
+            logger.debug("LLM connection warmed up")
+        except Exception as e:
+            logger.warning("LLM warmup request failed: %s", e)
+
+    async def close(self):
+        """Close the shared HTTP connection pool."""
+        await self.http_client.aclose()
+
+    def get_session_history(self, session_id: str) -> BoundedChatMessageHistory:
+        """Return the message history for a session, creating it on first use."""
+        if session_id not in self._histories:
+            self._histories[session_id] = BoundedChatMessageHistory()
+        return self._histories[session_id]
+
+    def record_turn(self, session_id: str, text: str, response_text: str):
+        """Add a turn that was answered without the LLM (e.g. from a cache) to the session history."""
+        history = self.get_session_history(session_id)
+        history.add_user_message(text)
+        history.add_ai_message(response_text)
+
+    def end_session(self, session_id: str):
+        """Drop the message history of a closed session."""
+        self._histories.pop(session_id, None)
+
+    # Note: History is kept per connection, keyed by the session id main.py assigns.
+    def generate_response(self, text: str, session_id: str) -> ResponseStream:
         """
-        Generate a response using the LLMChain with conversation memory.
+        Stream a response from the LLM, token by token, using the session's history.
+        
+        The full turn is saved to the session history once the stream completes.
         
         Args:
             text: The transcribed Hebrew text from the user.
-            memory: The ConversationBufferMemory instance for this session.
+            session_id: Identifier of the conversation (one per WebSocket connection).
             
         Returns:
-            LLM-generated response in Hebrew.
+            A ResponseStream yielding fragments of the LLM-generated response in Hebrew.
         """
+        stream = ResponseStream()
+        stream.fragments = self._stream_fragments(text, session_id, stream)
+        return stream
+
+    async def _stream_fragments(self, text: str, session_id: str, stream: ResponseStream) -> AsyncIterator[str]:
+        """Yield the response fragments, flagging the stream as failed if the LLM call errors."""
+        has_output = False
         try:
             start_time = time.time()
             
-            # Create the LLMChain for this request, incorporating the memory
-            conversation_chain = LLMChain(
-                llm=self.llm,
-                prompt=self.prompt,
-                verbose=False, # Set to True for debugging LangChain steps
-                memory=memory
-            )
+            # Short chit-chat goes to the faster, cheaper model
+            model_key = "fast" if len(text.split()) < FAST_MODEL_MAX_WORDS else "strong"
+            logger.debug("Routing %d-word utterance to the %s model", len(text.split()), model_key)
 
-            # Run the chain asynchronously
-            # Use .ainvoke for the async version of the chain
-            response = await conversation_chain.ainvoke({"input": text})
-            response_text = response.get("text", "") # Extract the response text
+            # Stream the completion; each chunk carries a small piece of the answer
+            config = {"configurable": {"session_id": session_id, "llm": model_key}}
+            async for chunk in self.chain_with_history.astream({"input": text}, config=config):
+                if chunk.content:
+                    has_output = True
+                    yield chunk.content
 
             # Log response time
             time_taken = time.time() - start_time
-            logger.debug(f"LLM response generated in {time_taken:.2f} seconds (via LangChain)")
-            
-            return response_text.strip()
+            logger.debug("LLM response streamed in %.2f seconds (via LangChain)", time_taken)
             
         except Exception as e:
-            logger.error(f"Error generating LLM response via LangChain: {str(e)}", exc_info=True)
-            return "סליחה, אני לא יכול לענות כרגע. נא לנסות שוב מאוחר יותר."
+            logger.error("Error generating LLM response via LangChain: %s", e)
+            stream.failed = True
+            if not has_output:
+                yield FALLBACK_RESPONSE
@@ -0,0 +1,233 @@
+import asyncio
+import logging
+import os
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+import numpy as np
+from openai import AsyncOpenAI
+
+logger = logging.getLogger(__name__)
+
+# The LLM is asked to start answers that depend on earlier turns with this marker.
+# Such answers are only valid in their original context, so they are never cached.
+NO_CACHE_MARKER = "[no-cache]"
+
+
+class CachedResponse(NamedTuple):
+    """A cached assistant turn: the spoken sentences and their synthesized audio, in order."""
+    sentences: Tuple[str, ...]
+    audio: Tuple[bytes, ...]
+
+
+class EmbeddingBatcher:
+    """
+    Coalesces concurrent embedding requests into a single API call.
+
+    Texts submitted within a short window (or until the batch is full) are sent in one
+    embeddings request, and each caller receives its own vector through a future.
+    """
+
+    def __init__(self, client: AsyncOpenAI, model_name: str, max_batch_size: int = 2048, max_wait_ms: float = 20):
+        """
+        Args:
+            client: The OpenAI client used for the embeddings requests
+            model_name: The embedding model
+            max_batch_size: Maximum inputs per request (the API accepts up to 2048)
+            max_wait_ms: How long the first text of a batch waits for others to join
+        """
+        self.client = client
+        self.model_name = model_name
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        # Keep references to in-flight batch tasks so they are not garbage collected
+        self._pending: Set[asyncio.Task] = set()
+
+    async def embed(self, text: str) -> List[float]:
+        """
+        Embed a text as part of the next batch.
+
+        Args:
+            text: The text to embed
+
+        Returns:
+            The embedding vector
+        """
+        # Start the worker lazily, inside the running event loop
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((text, future))
+        return await future
+
+    async def close(self):
+        """Stop the background worker and the batches in flight, before the HTTP client closes."""
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+        # Texts still waiting for a batch will not be embedded
+        while self._queue is not None and not self._queue.empty():
+            _, future = self._queue.get_nowait()
+            future.cancel()
+        pending = list(self._pending)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _run(self):
+        """Collect queued texts into batches and dispatch them."""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # Send the batch without blocking collection of the next one
+            task = asyncio.create_task(self._embed_batch(batch))
+            self._pending.add(task)
+            task.add_done_callback(self._pending.discard)
+
+    async def _embed_batch(self, batch: List[Tuple[str, asyncio.Future]]):
+        """Embed one batch and resolve the callers' futures."""
+        try:
+            response = await self.client.embeddings.create(
+                model=self.model_name, input=[text for text, _ in batch]
+            )
+            logger.debug("Embedded a batch of %d texts", len(batch))
+            for (_, future), item in zip(batch, sorted(response.data, key=lambda item: item.index)):
+                if not future.done():
+                    future.set_result(item.embedding)
+        except asyncio.CancelledError:
+            # Shutting down: release the callers rather than leave them waiting forever
+            for _, future in batch:
+                future.cancel()
+            raise
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+
+class SemanticCache:
+    """
+    In-memory cache of responses keyed by the meaning of the user's utterance.
+
+    Utterances are embedded with an OpenAI embedding model; a new utterance whose
+    cosine similarity to a cached one reaches the threshold reuses the cached text and
+    audio, skipping both the LLM and the TTS calls. Entries are namespaced (one
+    namespace per session) so responses never leak between users.
+    """
+
+    def __init__(self, client: AsyncOpenAI):
+        """
+        Initialize the semantic cache.
+
+        Args:
+            client: The OpenAI client used for embeddings (shared with the LLM service)
+        """
+        self.client = client
+        self.model_name = "text-embedding-3-small"
+        self.threshold = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.93"))
+        self.max_entries = int(os.getenv("SEMANTIC_CACHE_SIZE", "512"))
+        self.batcher = EmbeddingBatcher(self.client, self.model_name)
+
+        # LRU order over all namespaces: (namespace, entry id) -> (embedding, response)
+        self._entries: "OrderedDict[Tuple[str, int], Tuple[np.ndarray, CachedResponse]]" = OrderedDict()
+        # Per-namespace embedding matrix and the entry keys of its rows, rebuilt lazily
+        self._index: Dict[str, Tuple[np.ndarray, List[Tuple[str, int]]]] = {}
+        self._next_id = 0
+        logger.info("Initialized semantic cache with model: %s, threshold: %s", self.model_name, self.threshold)
+
+    async def embed(self, text: str) -> Optional[np.ndarray]:
+        """
+        Embed an utterance for cache lookup.
+
+        Args:
+            text: The transcribed user utterance
+
+        Returns:
+            The unit-length float32 embedding, or None if the embedding call failed
+        """
+        try:
+            embedding = np.asarray(await self.batcher.embed(text), dtype=np.float32)
+            return embedding / np.linalg.norm(embedding)
+        except Exception as e:
+            logger.error("Error embedding text for the semantic cache: %s", e)
+            return None
+
+    def has_entries(self, namespace: str) -> bool:
+        """Whether a namespace has anything cached, i.e. whether a lookup could hit."""
+        return self._get_index(namespace) is not None
+
+    def lookup(self, namespace: str, embedding: np.ndarray) -> Optional[CachedResponse]:
+        """
+        Find the cached response whose utterance is most similar to the given embedding.
+
+        Args:
+            namespace: The cache namespace (session id)
+            embedding: Unit-length embedding of the new utterance
+
+        Returns:
+            The cached response if its similarity reaches the threshold, otherwise None
+        """
+        index = self._get_index(namespace)
+        if index is None:
+            return None
+        matrix, keys = index
+
+        similarities = matrix @ embedding
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.threshold:
+            return None
+
+        key = keys[best]
+        self._entries.move_to_end(key)
+        logger.debug("Semantic cache hit (similarity %.3f)", similarities[best])
+        return self._entries[key][1]
+
+    def store(self, namespace: str, embedding: np.ndarray, response: CachedResponse):
+        """
+        Add a response to the cache, evicting the least recently used entry when full.
+
+        Args:
+            namespace: The cache namespace (session id)
+            embedding: Unit-length embedding of the utterance that produced the response
+            response: The response sentences and audio to reuse
+        """
+        key = (namespace, self._next_id)
+        self._next_id += 1
+        self._entries[key] = (embedding, response)
+        self._index.pop(namespace, None)
+
+        if len(self._entries) > self.max_entries:
+            (evicted_namespace, _), _ = self._entries.popitem(last=False)
+            self._index.pop(evicted_namespace, None)
+
+    def clear(self, namespace: str):
+        """Remove all entries of a namespace, e.g. when its session ends."""
+        for key in [key for key in self._entries if key[0] == namespace]:
+            del self._entries[key]
+        self._index.pop(namespace, None)
+
+    async def close(self):
+        """Stop embedding; call before the shared OpenAI client is closed."""
+        await self.batcher.close()
+
+    def _get_index(self, namespace: str) -> Optional[Tuple[np.ndarray, List[Tuple[str, int]]]]:
+        """Return the embedding matrix of a namespace, building it if it is stale."""
+        if namespace not in self._index:
+            keys = [key for key in self._entries if key[0] == namespace]
+            if not keys:
+                return None
+            matrix = np.stack([self._entries[key][0] for key in keys])
+            self._index[namespace] = (matrix, keys)
+        return self._index[namespace]
@@ -1,11 +1,94 @@
+import asyncio
 import io
 import logging
 import os
+from functools import lru_cache
+from typing import AsyncIterator, Optional
+import numpy as np
+import soundfile as sf
 from google.cloud import speech_v1p1beta1 as speech
+from google.cloud.speech_v1p1beta1.services.speech.transports import SpeechGrpcAsyncIOTransport
 from pydub import AudioSegment
+from scipy.signal import resample_poly
+from .grpc_channel import GRPC_CHANNEL_OPTIONS
 
 logger = logging.getLogger(__name__)
 
+# Google STT gives the best results for LINEAR16 (16-bit PCM) mono audio at 16kHz
+TARGET_SAMPLE_RATE = 16000
+
+# Opus audio (what browsers' MediaRecorder produces) is coded at 48kHz
+OPUS_SAMPLE_RATE = 48000
+
+# Container magic bytes and the markers identifying an Opus track inside them
+WEBM_MAGIC = b"\x1aE\xdf\xa3"
+WEBM_OPUS_CODEC_ID = b"A_OPUS"
+OGG_MAGIC = b"OggS"
+OGG_OPUS_HEAD = b"OpusHead"
+
+
+def detect_opus_encoding(header: bytes) -> Optional[speech.RecognitionConfig.AudioEncoding]:
+    """
+    Detect WebM/Opus or Ogg/Opus audio, which Google STT accepts without transcoding.
+    
+    Args:
+        header: The first bytes of the audio stream (at least the container header)
+        
+    Returns:
+        The matching STT encoding, or None if the audio has to be decoded first
+    """
+    if header.startswith(WEBM_MAGIC) and WEBM_OPUS_CODEC_ID in header[:4096]:
+        return speech.RecognitionConfig.AudioEncoding.WEBM_OPUS
+    if header.startswith(OGG_MAGIC) and OGG_OPUS_HEAD in header[:64]:
+        return speech.RecognitionConfig.AudioEncoding.OGG_OPUS
+    return None
+
+
+def decode_to_linear16(audio_data: bytes) -> bytes:
+    """
+    Decode audio into raw 16kHz mono 16-bit PCM (no container header).
+    
+    Only needed for audio that is not Opus (see detect_opus_encoding).
+    Formats libsndfile understands (WAV, FLAC, OGG, ...) are decoded and resampled
+    in-process with numpy/scipy. Anything else (e.g. MP4/AAC) falls back to pydub,
+    which shells out to ffmpeg.
+    
+    Args:
+        audio_data: Encoded audio bytes from the client
+        
+    Returns:
+        Little-endian 16-bit PCM samples at TARGET_SAMPLE_RATE
+    """
+    try:
+        data, sample_rate = sf.read(io.BytesIO(audio_data), dtype="float32", always_2d=True)
+    except RuntimeError:
+        # libsndfile cannot read this container; let ffmpeg handle it
+        audio = AudioSegment.from_file(io.BytesIO(audio_data))
+        audio = audio.set_channels(1).set_frame_rate(TARGET_SAMPLE_RATE).set_sample_width(2)
+        return audio.raw_data
+
+    # Downmix to mono, then resample with a polyphase filter if needed
+    samples = data.mean(axis=1) if data.shape[1] > 1 else data[:, 0]
+    if sample_rate != TARGET_SAMPLE_RATE:
+        samples = resample_poly(samples, TARGET_SAMPLE_RATE, sample_rate)
+
+    return (np.clip(samples, -1.0, 1.0) * 32767).astype("<i2").tobytes()
+
+
+@lru_cache()
+def get_speech_client() -> speech.SpeechAsyncClient:
+    """
+    Return the process-wide Speech-to-Text client, creating it on first use.
+    
+    Every SpeechToTextService shares this client and its gRPC channel. The first call
+    must happen inside the running event loop the client will be used from.
+    """
+    channel = SpeechGrpcAsyncIOTransport.create_channel(
+        "speech.googleapis.com:443", options=GRPC_CHANNEL_OPTIONS
+    )
+    return speech.SpeechAsyncClient(transport=SpeechGrpcAsyncIOTransport(channel=channel))
+
+
 class SpeechToTextService:
     """
     Service for transcribing audio to text using Google Cloud Speech-to-Text API.
@@ -14,9 +97,10 @@ class SpeechToTextService:
     
     def __init__(self):
         """Initialize the Speech-to-Text service with Google Cloud credentials."""
-        self.client = speech.SpeechClient()
+        # Shared async gRPC client, so recognition never blocks the event loop
+        self.client = get_speech_client()
         self.language_code = os.getenv("DEFAULT_LANGUAGE_CODE", "he-IL")
-        logger.info(f"Initialized Speech-to-Text service with language code: {self.language_code}")
+        logger.info("Initialized Speech-to-Text service with language code: %s", self.language_code)
     
     async def transcribe(self, audio_data: bytes) -> str:
         """
@@ -29,33 +113,23 @@ class SpeechToTextService:
             Transcribed text in Hebrew
         """
         try:
-            # Convert audio to proper format if needed
-            # Google STT expects LINEAR16 (PCM) audio at 16kHz sample rate for optimal results
-            audio = AudioSegment.from_file(io.BytesIO(audio_data))
-            
-            # Ensure correct format for Google STT (mono, 16kHz, 16-bit PCM)
-            if audio.channels > 1:
-                audio = audio.set_channels(1)  # Convert to mono
-            
-            if audio.frame_rate != 16000:
-                audio = audio.set_frame_rate(16000)  # Convert to 16kHz
-            
-            # Export as WAV in memory, explicitly setting 16-bit sample width (2 bytes)
-            buf = io.BytesIO()
-            # The 'sample_width' parameter is often controlled via codec settings or might not be directly exposed.
-            # A common way is to ensure the AudioSegment itself is 16-bit before export,
-            # or specify parameters during export if the format supports it.
-            # Let's ensure the AudioSegment's sample_width is 2 before exporting.
-            audio = audio.set_sample_width(2) # Set sample width to 16-bit
-            
-            audio.export(buf, format="wav") # Export the 16-bit audio
-            content = buf.getvalue()
-            logger.debug(f"Exported WAV content size: {len(content)} bytes, Sample Width: {audio.sample_width}")
+            # Opus in WebM/Ogg (the browser's format) is sent as is
+            encoding = detect_opus_encoding(audio_data)
+            if encoding is not None:
+                content = audio_data
+                sample_rate = OPUS_SAMPLE_RATE
+            else:
+                # Convert other audio to raw LINEAR16 PCM; the API accepts it without a WAV header.
+                # Decoding is CPU-bound (and may run ffmpeg), so keep it off the event loop.
+                content = await asyncio.to_thread(decode_to_linear16, audio_data)
+                encoding = speech.RecognitionConfig.AudioEncoding.LINEAR16
+                sample_rate = TARGET_SAMPLE_RATE
+                logger.debug("Decoded PCM content size: %d bytes", len(content))
             
             # Configure request
             config = speech.RecognitionConfig(
-                encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
-                sample_rate_hertz=16000,
+                encoding=encoding,
+                sample_rate_hertz=sample_rate,
                 language_code=self.language_code,
                 # Enable automatic punctuation
                 enable_automatic_punctuation=True,
@@ -68,7 +142,7 @@ class SpeechToTextService:
             audio = speech.RecognitionAudio(content=content)
             
             # Send request
-            response = self.client.recognize(config=config, audio=audio)
+            response = await self.client.recognize(config=config, audio=audio)
             
             # Process response
             full_transcript = ""
@@ -76,10 +150,76 @@ class SpeechToTextService:
                 transcript = result.alternatives[0].transcript
                 full_transcript += transcript + " "
             
-            logger.debug(f"Transcription complete: {full_transcript}")
+            logger.debug("Transcription complete: %s", full_transcript)
             return full_transcript.strip()
             
         except Exception as e:
-            logger.error(f"Error in transcription: {str(e)}")
+            logger.error("Error in transcription: %s", e)
             # Return empty string on error, the main.py will handle this
             return ""
+
+    async def stream_transcribe(self, chunk_iter: AsyncIterator[bytes]) -> AsyncIterator[str]:
+        """
+        Transcribe audio while it is still being received.
+        
+        Chunks are forwarded to Google's streaming recognizer as they arrive, so
+        recognition runs alongside the upload instead of after it. The utterance is
+        final only once chunk_iter ends (the user stopped recording), so pauses in
+        speech don't cut it short.
+        
+        Only Opus (WebM or Ogg) can be streamed as is; other formats are collected
+        and transcribed in one request once the utterance is complete.
+        
+        Args:
+            chunk_iter: Audio chunks from the client, in recording order
+            
+        Yields:
+            Final transcript segments in Hebrew
+        """
+        chunk_iter = chunk_iter.__aiter__()
+        try:
+            first_chunk = await chunk_iter.__anext__()
+        except StopAsyncIteration:
+            return
+
+        encoding = detect_opus_encoding(first_chunk)
+        if encoding is None:
+            chunks = [first_chunk] + [chunk async for chunk in chunk_iter]
+            transcript = await self.transcribe(b"".join(chunks))
+            if transcript:
+                yield transcript
+            return
+
+        streaming_config = speech.StreamingRecognitionConfig(
+            config=speech.RecognitionConfig(
+                encoding=encoding,
+                sample_rate_hertz=OPUS_SAMPLE_RATE,
+                language_code=self.language_code,
+                enable_automatic_punctuation=True,
+            ),
+            interim_results=True,
+        )
+
+        async def requests():
+            # The first request carries the configuration, the rest carry audio
+            yield speech.StreamingRecognizeRequest(streaming_config=streaming_config)
+            yield speech.StreamingRecognizeRequest(audio_content=first_chunk)
+            async for chunk in chunk_iter:
+                yield speech.StreamingRecognizeRequest(audio_content=chunk)
+
+        try:
+            responses = await self.client.streaming_recognize(requests=requests())
+            async for response in responses:
+                for result in response.results:
+                    if not result.alternatives:
+                        continue
+                    transcript = result.alternatives[0].transcript
+                    if result.is_final:
+                        logger.debug("Final transcript segment: %s", transcript)
+                        yield transcript.strip()
+                    else:
+                        logger.debug("Interim transcript: %s", transcript)
+                        
+        except Exception as e:
+            logger.error("Error in streaming transcription: %s", e)
+            # Yield nothing more on error, the main.py will handle an empty transcript
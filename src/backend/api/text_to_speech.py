@@ -1,10 +1,38 @@
-import io
 import logging
 import os
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, Iterable, Optional, Tuple
 from google.cloud import texttospeech
+from google.cloud.texttospeech_v1.services.text_to_speech.transports import TextToSpeechGrpcAsyncIOTransport
+from .grpc_channel import GRPC_CHANNEL_OPTIONS
 
 logger = logging.getLogger(__name__)
 
+# LRU cache of synthesized audio, keyed by (text, voice, language, speaking rate)
+TTS_CACHE_SIZE = 256
+_tts_cache: "OrderedDict[Tuple[str, str, str, float, int], bytes]" = OrderedDict()
+
+# Output encodings a client may ask for. Ogg/Opus is smaller than MP3 at the same quality
+# and cheap for browsers to decode; MP3 is for browsers that can't play Ogg/Opus (older Safari).
+SUPPORTED_AUDIO_ENCODINGS = (texttospeech.AudioEncoding.OGG_OPUS, texttospeech.AudioEncoding.MP3)
+
+
+
+@lru_cache()
+def get_tts_client() -> texttospeech.TextToSpeechAsyncClient:
+    """
+    Return the process-wide Text-to-Speech client, creating it on first use.
+    
+    Every TextToSpeechService shares this client and its gRPC channel. The first call
+    must happen inside the running event loop the client will be used from.
+    """
+    channel = TextToSpeechGrpcAsyncIOTransport.create_channel(
+        "texttospeech.googleapis.com:443", options=GRPC_CHANNEL_OPTIONS
+    )
+    return texttospeech.TextToSpeechAsyncClient(transport=TextToSpeechGrpcAsyncIOTransport(channel=channel))
+
+
 class TextToSpeechService:
     """
     Service for converting text to speech using Google Cloud Text-to-Speech API.
@@ -13,58 +41,122 @@ class TextToSpeechService:
     
     def __init__(self):
         """Initialize the Text-to-Speech service with Google Cloud credentials."""
-        self.client = texttospeech.TextToSpeechClient()
+        # Shared async gRPC client, so synthesis never blocks the event loop
+        self.client = get_tts_client()
         self.language_code = os.getenv("DEFAULT_LANGUAGE_CODE", "he-IL")
         self.voice_name = os.getenv("DEFAULT_VOICE_NAME", "he-IL-Standard-A")
-        logger.info(f"Initialized Text-to-Speech service with voice: {self.voice_name}")
+        logger.info("Initialized Text-to-Speech service with voice: %s", self.voice_name)
         
-        # Default audio configuration
-        self.audio_config = texttospeech.AudioConfig(
-            audio_encoding=texttospeech.AudioEncoding.MP3,
-            speaking_rate=1.0,  # Normal speaking rate
-            pitch=0.0,  # Default pitch
-            # Sample rate might need adjustment based on the client-side capabilities
-            sample_rate_hertz=24000
+        # Encoding for clients that don't state a preference
+        encoding_name = os.getenv("TTS_AUDIO_ENCODING", "OGG_OPUS")
+        supported = {encoding.name: encoding for encoding in SUPPORTED_AUDIO_ENCODINGS}
+        if encoding_name not in supported:
+            logger.warning("Unsupported TTS_AUDIO_ENCODING %s, using OGG_OPUS (supported: %s)",
+                           encoding_name, ", ".join(supported))
+        self.audio_encoding = supported.get(encoding_name, texttospeech.AudioEncoding.OGG_OPUS)
+        
+        # Audio configuration per supported encoding
+        self.audio_configs: Dict[texttospeech.AudioEncoding, texttospeech.AudioConfig] = {
+            encoding: texttospeech.AudioConfig(
+                audio_encoding=encoding,
+                speaking_rate=1.0,  # Normal speaking rate
+                pitch=0.0,  # Default pitch
+                # Sample rate might need adjustment based on the client-side capabilities
+                sample_rate_hertz=24000
+            )
+            for encoding in SUPPORTED_AUDIO_ENCODINGS
+        }
+        
+        # Voice selection
+        self.voice = texttospeech.VoiceSelectionParams(
+            language_code=self.language_code,
+            name=self.voice_name,
+            # For Hebrew, you might want to try different genders and options
+            # Adjust as necessary for better pronunciation
+            ssml_gender=texttospeech.SsmlVoiceGender.NEUTRAL
         )
+
+    def resolve_encoding(self, name: Optional[str]) -> texttospeech.AudioEncoding:
+        """
+        Map a client's requested encoding name to a supported encoding.
+        
+        Args:
+            name: Encoding name sent by the client (e.g. "OGG_OPUS" or "MP3"), if any
+            
+        Returns:
+            The requested encoding if supported, otherwise the default one
+        """
+        for encoding in SUPPORTED_AUDIO_ENCODINGS:
+            if encoding.name == name:
+                return encoding
+        return self.audio_encoding
+
+    def _cache_key(self, text: str, audio_config: texttospeech.AudioConfig) -> Tuple[str, str, str, float, int]:
+        """Key identifying the audio produced for a text with the given voice settings."""
+        return (text, self.voice_name, self.language_code, audio_config.speaking_rate, int(audio_config.audio_encoding))
+
+    async def warmup(self):
+        """Open the gRPC channel with a cheap call, so the first synthesis doesn't pay for it."""
+        try:
+            await self.client.list_voices(language_code=self.language_code)
+            logger.debug("Text-to-Speech connection warmed up")
+        except Exception as e:
+            logger.warning("Text-to-Speech warmup call failed: %s", e)
+
+    async def prewarm(self, phrases: Iterable[str]):
+        """
+        Synthesize fixed phrases ahead of time so their first use is served from the cache.
+        
+        Args:
+            phrases: Texts that are known to be spoken often (e.g. error messages)
+        """
+        for phrase in phrases:
+            for encoding in SUPPORTED_AUDIO_ENCODINGS:
+                await self.synthesize(phrase, encoding)
     
-    async def synthesize(self, text: str) -> bytes:
+    async def synthesize(self, text: str, audio_encoding: Optional[texttospeech.AudioEncoding] = None) -> bytes:
         """
         Convert text to speech.
         
+        The streaming pipeline calls this once per sentence, concurrently, so long
+        answers are already synthesized in parallel.
+        
         Args:
             text: Text to be converted to speech (in Hebrew)
+            audio_encoding: Output encoding (one of SUPPORTED_AUDIO_ENCODINGS); defaults to the service default
             
         Returns:
             Synthesized audio bytes
         """
+        audio_config = self.audio_configs[audio_encoding or self.audio_encoding]
+        key = self._cache_key(text, audio_config)
+        cached = _tts_cache.get(key)
+        if cached is not None:
+            _tts_cache.move_to_end(key)
+            logger.debug("TTS cache hit for %d characters of text", len(text))
+            return cached
+
         try:
-            # Build the voice request
-            synthesis_input = texttospeech.SynthesisInput(text=text)
-            
-            # Voice selection
-            voice = texttospeech.VoiceSelectionParams(
-                language_code=self.language_code,
-                name=self.voice_name,
-                # For Hebrew, you might want to try different genders and options
-                # Adjust as necessary for better pronunciation
-                ssml_gender=texttospeech.SsmlVoiceGender.NEUTRAL
-            )
-            
             # Send request
-            response = self.client.synthesize_speech(
-                input=synthesis_input,
-                voice=voice,
-                audio_config=self.audio_config
+            response = await self.client.synthesize_speech(
+                input=texttospeech.SynthesisInput(text=text),
+                voice=self.voice,
+                audio_config=audio_config
             )
             
             # Get audio content
             audio_content = response.audio_content
-            logger.debug(f"Synthesized {len(audio_content)} bytes of audio")
+            logger.debug("Synthesized %d bytes of audio", len(audio_content))
             
+            _tts_cache[key] = audio_content
+            _tts_cache.move_to_end(key)
+            if len(_tts_cache) > TTS_CACHE_SIZE:
+                _tts_cache.popitem(last=False)
+
             return audio_content
             
         except Exception as e:
-            logger.error(f"Error in text-to-speech synthesis: {str(e)}")
+            logger.error("Error in text-to-speech synthesis: %s", e)
             # Return an empty bytes object on error
             # Main.py will handle this appropriately
             return b""
@@ -1,18 +1,23 @@
 import logging
 import os
 import asyncio
+import re
+import uuid
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, List, Optional, Tuple
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-import json
+from google.cloud import texttospeech
+import orjson
 import uvicorn
 from dotenv import load_dotenv
-from langchain.memory import ConversationBufferMemory # Import Memory
 
 # Import our API modules
 from .api.speech_to_text import SpeechToTextService
-from .api.llm import LLMService
+from .api.llm import LLMService, FALLBACK_RESPONSE
 from .api.text_to_speech import TextToSpeechService
+from .api.semantic_cache import SemanticCache, CachedResponse, NO_CACHE_MARKER
 
 # Load environment variables from .env file
 load_dotenv()
@@ -25,16 +30,40 @@ logging.basicConfig(
 # this is the logger
 logger = logging.getLogger(__name__)
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Initialize services inside the lifespan so every worker process (and its event
+    # loop) gets its own gRPC channels and HTTP connection pools
+    app.state.speech_to_text = SpeechToTextService()
+    app.state.llm_service = LLMService()
+    app.state.text_to_speech = TextToSpeechService()
+    app.state.semantic_cache = SemanticCache(app.state.llm_service.client)
+
+    # Connect before the first user arrives. The fallback answer is spoken exactly
+    # when things are already slow, so have it synthesized and cached too.
+    await app.state.text_to_speech.warmup()
+    # Prewarm the sentences exactly as the streaming pipeline dispatches them to TTS
+    fallback_sentences, remainder = split_sentences(FALLBACK_RESPONSE)
+    if remainder.strip():
+        fallback_sentences.append(remainder.strip())
+    await app.state.text_to_speech.prewarm(fallback_sentences)
+    yield
+    await app.state.semantic_cache.close()
+    await app.state.llm_service.close()
+
+
 # Initialize FastAPI app
 app = FastAPI(
     title="Hebrew Audio Chatbot",
     description="A chatbot that processes Hebrew speech and responds with audio",
     version="1.0.0",
+    lifespan=lifespan,
 )
 
 # Configure CORS
 if os.getenv("ENABLE_CORS", "true").lower() == "true":
-    origins = json.loads(os.getenv("CORS_ORIGINS", '["*"]'))
+    origins = orjson.loads(os.getenv("CORS_ORIGINS", '["*"]'))
     app.add_middleware(
         CORSMiddleware,
         allow_origins=origins,
@@ -43,64 +72,295 @@ if os.getenv("ENABLE_CORS", "true").lower() == "true":
         allow_headers=["*"],
     )
 
-# Initialize services
-speech_to_text = SpeechToTextService()
-llm_service = LLMService()
-text_to_speech = TextToSpeechService()
+
+# A sentence ends at . ? ! or the Armenian full stop (U+0589) followed by whitespace, or at a newline.
+# Requiring the trailing whitespace keeps decimals like "3.5" in one piece while streaming.
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.?!\u0589])\s+|\n+")
+
+
+def split_sentences(buffer: str) -> Tuple[List[str], str]:
+    """
+    Split complete sentences off the front of a streamed text buffer.
+    
+    Args:
+        buffer: Accumulated LLM output that has not been sent to TTS yet
+        
+    Returns:
+        The complete sentences found, and the unfinished remainder of the buffer
+    """
+    parts = SENTENCE_BOUNDARY.split(buffer)
+    sentences = [part.strip() for part in parts[:-1] if part.strip()]
+    return sentences, parts[-1]
+
+
+async def send_json(websocket: WebSocket, payload: dict) -> None:
+    """
+    Send a control message to the client as JSON.
+    
+    Messages go out as text frames serialized with orjson; binary frames are reserved
+    for TTS audio.
+    
+    Args:
+        websocket: The client connection
+        payload: The message, with its "type" and fields
+    """
+    await websocket.send_text(orjson.dumps(payload).decode())
+
+
+async def stream_response(websocket: WebSocket, text: str, session_id: str,
+                          audio_encoding: texttospeech.AudioEncoding) -> None:
+    """
+    Stream the LLM answer to the client, synthesizing speech one sentence at a time.
+    
+    Each finished sentence is dispatched to TTS immediately, so synthesis overlaps with
+    the rest of the LLM generation. A single sender drains the queue in sentence order.
+    Responses to utterances similar to an earlier one in the session are replayed from
+    the semantic cache without calling the LLM or TTS. While the session has nothing
+    cached, the utterance is embedded alongside the LLM stream (only needed to store
+    the answer) instead of delaying it.
+    
+    Args:
+        websocket: The client connection
+        text: The transcribed user utterance
+        session_id: The conversation id of this connection
+        audio_encoding: The TTS output encoding the client can play
+    """
+    services = websocket.app.state
+    embedding_task = asyncio.create_task(services.semantic_cache.embed(text))
+    cached = None
+    if services.semantic_cache.has_entries(session_id):
+        embedding = await embedding_task
+        cached = services.semantic_cache.lookup(session_id, embedding) if embedding is not None else None
+    if cached:
+        for sentence, audio_response in zip(cached.sentences, cached.audio):
+            await send_json(websocket, {"type": "llm_response", "text": sentence})
+            await websocket.send_bytes(audio_response)
+        services.llm_service.record_turn(session_id, text, " ".join(cached.sentences))
+        await send_json(websocket, {"type": "response_end"})
+        return
+
+    audio_queue: asyncio.Queue = asyncio.Queue()
+    sent_sentences: List[str] = []
+    sent_audio: List[bytes] = []
+    tts_tasks: List[asyncio.Task] = []
+    cacheable = True
+
+    async def send_in_order():
+        while True:
+            item = await audio_queue.get()
+            if item is None:
+                break
+            sentence, tts_task = item
+            # Send the LLM text (optional, for UI update) while its audio is still being synthesized
+            audio_response, _ = await asyncio.gather(
+                tts_task,
+                send_json(websocket, {"type": "llm_response", "text": sentence}),
+            )
+            if audio_response:
+                await websocket.send_bytes(audio_response)
+            sent_sentences.append(sentence)
+            sent_audio.append(audio_response)
+
+    def dispatch(sentence: str):
+        nonlocal cacheable
+        # The marker has no whitespace, so it never straddles a sentence boundary;
+        # wherever the model put it, it is neither shown nor spoken
+        if NO_CACHE_MARKER in sentence:
+            cacheable = False
+            sentence = sentence.replace(NO_CACHE_MARKER, "").strip()
+            if not sentence:
+                return
+        tts_task = asyncio.create_task(services.text_to_speech.synthesize(sentence, audio_encoding))
+        tts_tasks.append(tts_task)
+        audio_queue.put_nowait((sentence, tts_task))
+
+    sender = asyncio.create_task(send_in_order())
+    llm_stream = services.llm_service.generate_response(text, session_id)
+    buffer = ""
+    try:
+        async for token in llm_stream:
+            buffer += token
+            # Every boundary ends in whitespace, so only such tokens can complete a sentence;
+            # skip re-scanning the buffer for the rest and go straight back to the stream
+            if any(char.isspace() for char in token):
+                sentences, buffer = split_sentences(buffer)
+                for sentence in sentences:
+                    dispatch(sentence)
+        if buffer.strip():
+            dispatch(buffer.strip())
+        audio_queue.put_nowait(None)
+        await sender
+    except BaseException:
+        # Cancelled (a newer utterance arrived) or failed: stop sending and drop pending synthesis
+        sender.cancel()
+        embedding_task.cancel()
+        for tts_task in tts_tasks:
+            tts_task.cancel()
+        raise
+    finally:
+        # Closes the OpenAI stream if the response was abandoned midway
+        await llm_stream.aclose()
+
+    # Only cache complete, context-free answers whose audio was synthesized successfully;
+    # a failed LLM call leaves the fallback answer (or a truncated one)
+    if cacheable and not llm_stream.failed and sent_audio and all(sent_audio):
+        embedding = await embedding_task
+        if embedding is not None:
+            services.semantic_cache.store(session_id, embedding, CachedResponse(tuple(sent_sentences), tuple(sent_audio)))
+    else:
+        embedding_task.cancel()
+
+    # Tell the client the turn is complete so it can return to the ready state after playback
+    await send_json(websocket, {"type": "response_end"})
+
+
+async def process_utterance(websocket: WebSocket, chunks: asyncio.Queue, session_id: str,
+                            audio_encoding: texttospeech.AudioEncoding,
+                            previous: Optional[asyncio.Task]) -> None:
+    """
+    Run one utterance through the pipeline: streaming STT, then the streamed LLM + TTS response.
+    
+    Args:
+        websocket: The client connection
+        chunks: Queue of audio chunks for this utterance, terminated by None
+        session_id: The conversation id of this connection
+        audio_encoding: The TTS output encoding the client can play
+        previous: The pipeline of the previous utterance. The caller cancels it if it is
+            still running; it is awaited here so its cleanup finishes before this one sends.
+            If it was cancelled, the client is told with a "response_cancelled" message
+            before anything of this utterance is sent.
+    """
+    services = websocket.app.state
+    if previous is not None:
+        await asyncio.wait([previous])
+
+    async def audio_chunks() -> AsyncIterator[bytes]:
+        while True:
+            chunk = await chunks.get()
+            if chunk is None:
+                return
+            yield chunk
+
+    try:
+        # The interrupted response will never get its response_end; close it explicitly
+        if previous is not None and previous.cancelled():
+            await send_json(websocket, {"type": "response_cancelled"})
+
+        # 1. Convert speech to text while the audio is still arriving
+        segments = [segment async for segment in services.speech_to_text.stream_transcribe(audio_chunks())]
+        text = " ".join(segments).strip()
+        logger.info("Transcribed text: %s", text)
+        
+        if not text:
+            await send_json(websocket, {"type": "error", "message": "Could not transcribe audio"})
+            return
+        # 2 + 3. Stream the LLM response and convert it to speech sentence by sentence,
+        # reporting the transcript to the client at the same time
+        await asyncio.gather(
+            send_json(websocket, {"type": "transcript", "text": text}),
+            stream_response(websocket, text, session_id, audio_encoding),
+        )
+        
+    except asyncio.CancelledError:
+        logger.info("Abandoned the response to a stale utterance")
+        raise
+    except Exception as e:
+        logger.error("Error processing utterance: %s", e, exc_info=True)
+        try:
+            await send_json(websocket, {"type": "error", "message": "An internal processing error occurred."})
+        except Exception as send_err:
+            logger.error("Failed to send error message to WebSocket: %s", send_err)
+
 
 # WebSocket endpoint for real-time audio processing
 @app.websocket("/ws/audio")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
     logger.info("WebSocket connection established")
+    services = websocket.app.state
+    
+    # Each connection gets its own conversation history in the LLM service
+    session_id = uuid.uuid4().hex
     
-    # Create a new memory instance for this connection
-    # "chat_history" is the key LangChain uses for messages in this memory type
-    memory = ConversationBufferMemory(memory_key="chat_history", return_messages=True) 
+    # Open a warm connection to OpenAI while the user is recording their first utterance
+    warmup_task = asyncio.create_task(services.llm_service.warmup())
+    
+    # The client streams an utterance as binary audio chunks followed by an
+    # {"type": "end_of_utterance"} text message. Chunks are fed to STT as they arrive.
+    # Starting a new utterance while a response is playing (barge-in) cancels that
+    # response; the client then receives {"type": "response_cancelled"} for it.
+    utterance_chunks: Optional[asyncio.Queue] = None
+    pipeline_task: Optional[asyncio.Task] = None
+    
+    # TTS encoding for this client; it may ask for another one with a "config" message
+    audio_encoding = services.text_to_speech.audio_encoding
     
     try:
         while True:
-            # Receive audio data from client (using non-streaming approach now)
-            audio_data = await websocket.receive_bytes()
-            if not audio_data:
-                 logger.info("Received empty bytes, closing connection.")
-                 break # Close connection if client sends empty bytes (might signify end)
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
 
-            logger.debug(f"Received audio data: {len(audio_data)} bytes")
-            
-            # Process audio through our pipeline
-            # 1. Convert speech to text
-            text = await speech_to_text.transcribe(audio_data)
-            logger.info(f"Transcribed text: {text}")
-            
-            if not text.strip():
-                await websocket.send_text(json.dumps({"type": "error", "message": "Could not transcribe audio"}))
-                continue
-            
-            # 2. Process with LLM (passing memory)
-            llm_response = await llm_service.generate_response(text, memory) # Pass memory object
-            logger.info(f"LLM response: {llm_response}")
-            
-            # 3. Convert text to speech
-            audio_response = await text_to_speech.synthesize(llm_response)
-            
-            # Send response back to client
-            # Send LLM text first (optional, for UI update)
-            await websocket.send_text(json.dumps({"type": "llm_response", "text": llm_response}))
-            # Then send audio
-            await websocket.send_bytes(audio_response)
+            audio_data = message.get("bytes")
+            if audio_data is not None:
+                if not audio_data:
+                     logger.info("Received empty bytes, closing connection.")
+                     break # Close connection if client sends empty bytes (might signify end)
+
+                # Fires for every chunk; skip the call entirely unless debugging
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Received audio data: %d bytes", len(audio_data))
+                
+                # The first chunk of an utterance starts its pipeline. A new utterance makes
+                # any response still in progress stale, so stop working on it.
+                if utterance_chunks is None:
+                    if pipeline_task is not None and not pipeline_task.done():
+                        pipeline_task.cancel()
+                    utterance_chunks = asyncio.Queue()
+                    pipeline_task = asyncio.create_task(
+                        process_utterance(websocket, utterance_chunks, session_id, audio_encoding, pipeline_task)
+                    )
+                utterance_chunks.put_nowait(audio_data)
+                
+            elif message.get("text"):
+                try:
+                    control = orjson.loads(message["text"])
+                except orjson.JSONDecodeError:
+                    control = None
+                if not isinstance(control, dict):
+                    # A malformed frame must not end the session (and drop its history)
+                    logger.warning("Ignoring invalid control message: %.100s", message["text"])
+                    continue
+                if control.get("type") == "config":
+                    audio_encoding = services.text_to_speech.resolve_encoding(control.get("audio_encoding"))
+                    # Cached responses hold audio in the previous encoding
+                    services.semantic_cache.clear(session_id)
+                    logger.info("Client requested TTS encoding %s", audio_encoding.name)
+                elif control.get("type") == "end_of_utterance":
+                    if utterance_chunks is not None:
+                        utterance_chunks.put_nowait(None)
+                        utterance_chunks = None
+                    else:
+                        # No audio arrived for this utterance; let the client return to ready
+                        await send_json(websocket, {"type": "response_end"})
             
     except WebSocketDisconnect:
         logger.info("WebSocket disconnected")
     except Exception as e:
-        logger.error(f"Error in WebSocket connection: {str(e)}", exc_info=True)
+        logger.error("Error in WebSocket connection: %s", e, exc_info=True)
         try:
             # Send error only if websocket still seems connected
             if websocket.client_state == 1: # STATE_CONNECTED = 1
-                 await websocket.send_text(json.dumps({"type": "error", "message": "An internal processing error occurred."}))
+                 await send_json(websocket, {"type": "error", "message": "An internal processing error occurred."})
         except Exception as send_err:
-            logger.error(f"Failed to send error message to WebSocket: {send_err}")
+            logger.error("Failed to send error message to WebSocket: %s", send_err)
     finally:
+         if pipeline_task is not None and not pipeline_task.done():
+             pipeline_task.cancel()
+         if not warmup_task.done():
+             warmup_task.cancel()
+         services.llm_service.end_session(session_id)
+         services.semantic_cache.clear(session_id)
          logger.info("WebSocket connection closed.")
 
 
@@ -116,14 +376,21 @@ app.mount("/", StaticFiles(directory="src/frontend", html=True), name="frontend"
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 8000))
     host = os.getenv("HOST", "0.0.0.0")
-    reload = os.getenv("RELOAD", "true").lower() == "true"
+    reload = os.getenv("RELOAD", "false").lower() == "true"
+    # One process by default: each worker loads its own models/clients, so only raise
+    # WORKERS when the host has the CPUs and memory for it. Reload mode supports only one.
+    workers = 1 if reload else int(os.getenv("WORKERS", "1"))
     log_level = os.getenv("LOG_LEVEL", "info").lower()
     
-    logger.info(f"Starting server on {host}:{port} (Reload: {reload}, Log Level: {log_level})")
+    logger.info("Starting server on %s:%d (Reload: %s, Workers: %d, Log Level: %s)", host, port, reload, workers, log_level)
     uvicorn.run(
         "src.backend.main:app", 
         host=host, 
         port=port, 
         reload=reload,
+        workers=workers,
+        loop="auto",  # uvloop when installed (not on Windows), asyncio otherwise
+        http="httptools",
+        access_log=False,
         log_level=log_level
     )
@@ -4,7 +4,7 @@
  * This module initializes and manages the audio chatbot functionality, including:
  * - Microphone access and audio recording (collecting chunks)
  * - Single button Start/Stop/Send interaction
- * - WebSocket communication with the backend (sending single audio blob)
+ * - WebSocket communication with the backend (streaming audio chunks while recording)
  * - UI interactions and visualization
  */
 
@@ -16,15 +16,20 @@ const state = {
     audioContext: null,      // Web Audio API context
     mediaStream: null,       // Microphone stream
     processor: null,         // Audio processor node (ScriptProcessorNode for simplicity now)
-    recorder: null,          // Using MediaRecorder again for blob creation
+    recorder: null,          // MediaRecorder producing the streamed audio chunks
     socket: null,            // WebSocket connection
     vad: null,               // Voice Activity Detector (basic integration)
     visualizer: null,        // Audio visualizer
-    audioChunks: [],         // Store audio chunks for blob creation
+    audioChunks: [],         // Audio chunks recorded (and streamed) for the current utterance
     retryCount: 0,           // Connection retry counter
     maxRetries: 3,           // Maximum connection retry attempts
     userMessageElement: null,// Reference to the current user message element for updates
     botMessageElement: null, // Reference to the current bot message element for updates
+    audioQueue: [],          // Sentence audio buffers waiting to be played, in arrival order
+    isPlaying: false,        // Is a response audio buffer currently playing
+    responseEnded: false,    // Has the server signalled the end of the current response
+    currentAudio: null,      // The Audio element playing the current sentence, if any
+    discardingStaleResponse: false, // Ignore the rest of a response interrupted by barge-in
     visualizerUpdater: null  // Holds the requestAnimationFrame ID for the visualizer
 };
 
@@ -120,6 +125,8 @@ function connectWebSocket() {
             state.isConnected = true;
             state.retryCount = 0;
             console.log('WebSocket connected');
+            // Ask for Ogg/Opus speech only if this browser can play it, MP3 otherwise
+            state.socket.send(JSON.stringify({ type: 'config', audio_encoding: preferredAudioEncoding() }));
             updateUIState('ready');
         };
         
@@ -161,18 +168,39 @@ function connectWebSocket() {
  * Toggles audio recording state and triggers send on stop
  */
 async function toggleRecording() {
-    if (state.isProcessing) return; 
-
     if (state.isRecording) {
         // Stop recording AND trigger send
         await stopRecordingInternal(true); 
         // UI state will be updated to 'sending' within stopRecordingInternal/onstop
     } else {
+        // Barge-in: recording over a response stops it (the server cancels it too)
+        if (state.isProcessing) interruptResponse();
         // Start recording
         await startRecordingInternal();
     }
 }
 
+/**
+ * Stops the response in progress so the user can speak over it
+ */
+function interruptResponse() {
+    if (state.currentAudio) {
+        const audio = state.currentAudio;
+        state.currentAudio = null;
+        audio.pause();
+        URL.revokeObjectURL(audio.src);
+    }
+    // Until the server closes the interrupted response (response_end, error or
+    // response_cancelled), whatever it still sends belongs to that response
+    state.discardingStaleResponse = !state.responseEnded;
+    state.audioQueue = [];
+    state.isPlaying = false;
+    state.responseEnded = false;
+    state.isProcessing = false;
+    state.userMessageElement = null;
+    state.botMessageElement = null;
+}
+
 // Removed sendRecording function as logic is merged into toggleRecording
 
 /**
@@ -250,6 +278,10 @@ async function startRecordingInternal() {
         state.recorder.ondataavailable = (event) => {
             if (event.data.size > 0) {
                 state.audioChunks.push(event.data);
+                // Stream each chunk right away so the server can transcribe while we record
+                if (state.isConnected && state.socket.readyState === WebSocket.OPEN) {
+                    state.socket.send(event.data);
+                }
             }
         };
 
@@ -264,8 +296,8 @@ async function startRecordingInternal() {
                  return;
              }
 
-             const audioBlob = new Blob(state.audioChunks, { type: state.recorder.mimeType });
-             console.log(`Created blob of type ${audioBlob.type}, size ${audioBlob.size}`);
+             const totalSize = state.audioChunks.reduce((size, chunk) => size + chunk.size, 0);
+             console.log(`Recorded ${state.audioChunks.length} chunks of type ${state.recorder.mimeType}, size ${totalSize}`);
              
              if (state.isConnected && state.socket.readyState === WebSocket.OPEN) {
                  try {
@@ -275,16 +307,16 @@ async function startRecordingInternal() {
                      } else { // Add message if none existed
                           state.userMessageElement = addUserMessage('🎤 שולח הקלטה...');
                      }
-                     const arrayBuffer = await audioBlob.arrayBuffer();
-                     console.log(`Sending audio blob as ArrayBuffer: ${arrayBuffer.byteLength} bytes`);
-                     state.socket.send(arrayBuffer);
+                     // The chunks were already streamed; mark the end of the utterance
+                     console.log("Sending end of utterance");
+                     state.socket.send(JSON.stringify({ type: 'end_of_utterance' }));
                  } catch (sendError) {
-                      console.error("Error sending audio blob:", sendError);
+                      console.error("Error sending end of utterance:", sendError);
                       showError("שגיאה בשליחת ההקלטה.");
                       updateUIState('ready');
                  }
              } else {
-                 console.error("WebSocket not open when trying to send blob.");
+                 console.error("WebSocket not open when trying to end the utterance.");
                  showError("שגיאה בשליחת ההקלטה (אין חיבור).");
                  updateUIState('ready');
              }
@@ -350,8 +382,10 @@ function handleServerMessage(event) {
     // Check if it's binary audio data first
     if (event.data instanceof ArrayBuffer) {
         console.log(`Received audio data: ${event.data.byteLength} bytes`);
-        if (event.data.byteLength > 0) {
-            playAudio(event.data); // Play the bot's audio response
+        if (state.discardingStaleResponse) {
+            console.log("Discarding audio of an interrupted response.");
+        } else if (event.data.byteLength > 0) {
+            enqueueAudio(event.data); // Queue the bot's audio response (one buffer per sentence)
         } else {
             console.log("Received empty audio buffer.");
              if (state.isProcessing) {
@@ -369,13 +403,31 @@ function handleServerMessage(event) {
                 case 'transcript': // Assuming backend sends this structure now
                     handleTranscript(message.text); 
                     break;
+                case 'llm_response': // Text of the sentence whose audio follows
+                    break;
+                case 'response_end': // All sentences of the response have been sent
+                    if (state.discardingStaleResponse) {
+                        state.discardingStaleResponse = false;
+                        break;
+                    }
+                    state.responseEnded = true;
+                    if (!state.isPlaying) finishResponse();
+                    break;
+                case 'response_cancelled': // The server stopped the response we interrupted
+                    state.discardingStaleResponse = false;
+                    break;
                 case 'error': // Handle errors from backend
+                    if (state.discardingStaleResponse) { // The interrupted response failed; nothing to show
+                        state.discardingStaleResponse = false;
+                        break;
+                    }
                     console.error('Server error:', message.message);
                     showError(`שגיאת שרת: ${message.message}`);
                     state.isProcessing = false;
                     updateUIState('ready');
                     state.userMessageElement = null;
                     state.botMessageElement = null;
+                    state.audioQueue = [];
                     break;
                 default:
                     console.warn('Unknown JSON message type:', message);
@@ -408,6 +460,7 @@ function handleTranscript(text) {
     
     // Assume transcript means STT is done. Wait for audio response.
     state.isProcessing = true; 
+    state.responseEnded = false;
     updateUIState('processing'); 
 }
 
@@ -416,14 +469,75 @@ function handleTranscript(text) {
  */
 // function handleLlmResponse(text) { ... } // Can be removed if LLM text isn't sent separately
 
+/**
+ * Queues a received audio buffer, starting playback if nothing is playing
+ */
+function enqueueAudio(audioData) {
+    state.audioQueue.push(audioData);
+    if (!state.isPlaying) playNextAudio();
+}
+
+/**
+ * Plays the next queued audio buffer, or finishes the response once the queue is drained
+ */
+function playNextAudio() {
+    const next = state.audioQueue.shift();
+    if (next) {
+        state.isPlaying = true;
+        playAudio(next);
+        return;
+    }
+    state.isPlaying = false;
+    if (state.responseEnded) finishResponse();
+}
+
+/**
+ * Returns the UI to the ready state once the whole response has been played
+ */
+function finishResponse() {
+    state.responseEnded = false;
+    state.isProcessing = false; // Processing ends AFTER audio playback
+    updateUIState('ready');
+    // Clear messages for next turn after a delay
+    setTimeout(() => {
+         // Check if elements still exist before nullifying
+         if (state.userMessageElement && state.userMessageElement.parentNode) {
+              state.userMessageElement.parentNode.removeChild(state.userMessageElement);
+         }
+         if (state.botMessageElement && state.botMessageElement.parentNode) {
+              state.botMessageElement.parentNode.removeChild(state.botMessageElement);
+         }
+         state.userMessageElement = null; 
+         state.botMessageElement = null;
+    }, 1500); // Delay before clearing messages
+}
+
+/**
+ * Returns the TTS encoding to request from the server: OGG_OPUS when playable, else MP3
+ */
+function preferredAudioEncoding() {
+    const canPlayOpus = new Audio().canPlayType('audio/ogg; codecs=opus') !== '';
+    return canPlayOpus ? 'OGG_OPUS' : 'MP3';
+}
+
+/**
+ * Returns the MIME type of a TTS audio buffer: Ogg/Opus (the server default) or MP3
+ */
+function audioMimeType(audioData) {
+    const header = new Uint8Array(audioData, 0, Math.min(4, audioData.byteLength));
+    const isOgg = String.fromCharCode(...header) === 'OggS';
+    return isOgg ? 'audio/ogg; codecs=opus' : 'audio/mpeg';
+}
+
 /**
  * Plays the received audio data (TTS response)
  */
 function playAudio(audioData) {
     try {
-        const audioBlob = new Blob([audioData], { type: 'audio/wav' }); 
+        const audioBlob = new Blob([audioData], { type: audioMimeType(audioData) }); 
         const audioUrl = URL.createObjectURL(audioBlob);
         const audio = new Audio(audioUrl);
+        state.currentAudio = audio;
         
         // Add bot message placeholder if it doesn't exist
         // We assume the bot message contains the LLM text already if backend sends it before audio
@@ -436,28 +550,20 @@ function playAudio(audioData) {
         }
         
         audio.onended = () => {
+            state.currentAudio = null;
             URL.revokeObjectURL(audioUrl);
             console.log("Audio playback finished.");
-            state.isProcessing = false; // Processing ends AFTER audio playback
-            updateUIState('ready');
-            // Clear messages for next turn after a delay
-            setTimeout(() => {
-                 // Check if elements still exist before nullifying
-                 if (state.userMessageElement && state.userMessageElement.parentNode) {
-                      state.userMessageElement.parentNode.removeChild(state.userMessageElement);
-                 }
-                 if (state.botMessageElement && state.botMessageElement.parentNode) {
-                      state.botMessageElement.parentNode.removeChild(state.botMessageElement);
-                 }
-                 state.userMessageElement = null; 
-                 state.botMessageElement = null;
-            }, 1500); // Delay before clearing messages
+            playNextAudio(); // Continue with the next sentence, if any
         };
         
         audio.onerror = (e) => {
+             if (audio !== state.currentAudio) return; // Interrupted by barge-in
+             state.currentAudio = null;
              console.error('Error playing audio:', e);
              URL.revokeObjectURL(audioUrl);
              showError('אירעה שגיאה בניגון השמע.');
+             state.isPlaying = false;
+             state.audioQueue = [];
              state.isProcessing = false;
              updateUIState('ready');
              state.userMessageElement = null;
@@ -465,7 +571,11 @@ function playAudio(audioData) {
         };
         
         audio.play().catch(error => {
+            if (audio !== state.currentAudio) return; // Paused by barge-in before it started
+            state.currentAudio = null;
             console.error('Error initiating audio playback:', error);
+            state.isPlaying = false;
+            state.audioQueue = [];
             state.isProcessing = false;
             updateUIState('ready');
             state.userMessageElement = null;
@@ -477,6 +587,8 @@ function playAudio(audioData) {
         
     } catch (error) {
         console.error('Error processing audio data:', error);
+        state.isPlaying = false;
+        state.audioQueue = [];
         state.isProcessing = false;
         updateUIState('ready');
         state.userMessageElement = null;
@@ -525,17 +637,16 @@ function updateUIState(newState) {
             recordBtn.classList.add('recording');
             break;
         // 'stopped' state removed as stop now triggers send
-        case 'sending': // Recording stopped, blob sent, waiting for server
+        case 'sending': // Recording stopped, audio sent, waiting for server
              statusText.textContent = 'שולח לשרת...';
              recordBtn.disabled = true; // Disable while sending
              recordBtn.querySelector('.record-text').textContent = 'שולח...';
              recordBtn.classList.remove('recording');
              break;
-        case 'processing': // Server is processing STT/LLM/TTS
-            statusText.textContent = 'מעבד...';
+        case 'processing': // Server is processing STT/LLM/TTS; recording again interrupts it
+            statusText.textContent = 'מעבד... (לחץ להקלטה כדי לקטוע)';
             statusText.classList.add('processing');
-            recordBtn.disabled = true;
-            recordBtn.querySelector('.record-text').textContent = 'מעבד...';
+            recordBtn.querySelector('.record-text').textContent = 'קטע והקלט';
             break;
     }
 }